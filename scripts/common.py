@@ -1,11 +1,11 @@
 # scripts/common.py
 # Minimal helper utilities shared by the demo scripts.
-# Deps: pandas, shapely, requests
+# Deps: pandas, numpy, pyarrow, shapely, aiohttp, tenacity (numba optional: speeds up pairs_within_km)
 
 from __future__ import annotations
-import os, re, time, math, json
+import os, re, time, math, json, hashlib
 from pathlib import Path
-import requests
+import numpy as np
 
 def find_data_file(name: str) -> str:
     """
@@ -26,27 +26,194 @@ def find_data_file(name: str) -> str:
 # ---------------------------
 # Geometry helpers (EWKT/WKT)
 # ---------------------------
+SRID_RE = re.compile(r"^SRID=\d+;")
+
 def strip_srid(geom: str) -> str:
-    """Turn 'SRID=4326;WKT...' into 'WKT...'"""
+    """Turn 'SRID=4326;WKT...' into 'WKT...'
+    (scalar version; for a whole column use series.str.replace(SRID_RE.pattern, "", regex=True))"""
     if not isinstance(geom, str):
         return geom
-    if geom.startswith("SRID="):
-        return geom.split(";", 1)[1]
-    return geom
-
-# ---------------------------
-# HTTP session with retries
-# ---------------------------
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-def make_retry_session(retries: int = 5, backoff: float = 1.0) -> requests.Session:
-    retry = Retry(
-        total=retries, connect=retries, read=retries,
-        backoff_factor=backoff, status_forcelist=(429,500,502,503,504),
-        allowed_methods=frozenset(["GET"]), raise_on_status=False
-    )
-    s = requests.Session()
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://",  HTTPAdapter(max_retries=retry))
-    return s
+    return SRID_RE.sub("", geom)
+
+# ---------------------------
+# Output tables (Parquet or CSV)
+# ---------------------------
+def arrow_schema(head, *sources):
+    """
+    Arrow schema for head's columns (names and order), e.g. head = events.iloc[:0].join(...).
+    Columns whose type head alone can't tell (empty/all-null object columns infer as null)
+    take their type from the full source frame that has them, so every slice shares one schema.
+    """
+    import pyarrow as pa
+    schema = pa.Schema.from_pandas(head, preserve_index=False)
+    fields = []
+    for f in schema:
+        if pa.types.is_null(f.type):
+            src = next((s for s in sources if f.name in s.columns), None)
+            if src is not None:
+                f = pa.Schema.from_pandas(src[[f.name]], preserve_index=False).field(f.name)
+        fields.append(f)
+    return pa.schema(fields)
+
+def write_frames(frames, path: Path, schema=None) -> int:
+    """
+    Write an iterable of same-shaped DataFrames to one file, picking the format from the suffix:
+    .parquet -> Snappy Parquet, one row group per frame (dtypes preserved); anything else -> CSV.
+    Frames are written as they arrive, so callers can stream. When streaming Parquet, pass a
+    schema built from the whole input (see arrow_schema): otherwise it is inferred from the first
+    frame, and a column that happens to be all-null there can't take values in later frames.
+    Returns the number of rows written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    rows, writer = 0, None
+    try:
+        for i, df in enumerate(frames):
+            if path.suffix == ".parquet":
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pq.ParquetWriter(path, schema, compression="snappy")
+                writer.write_table(table)
+            else:
+                df.to_csv(path, index=False, mode="w" if i == 0 else "a", header=(i == 0))
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+# ---------------------------
+# Distances
+# ---------------------------
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km. Works on scalars or NumPy arrays (broadcasting),
+    e.g. haversine_km(lat, lon, station_lats, station_lons) -> one distance per station.
+    """
+    R = 6371.0
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    dphi = p2 - p1
+    dlmb = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(dphi/2)**2 + np.cos(p1)*np.cos(p2)*np.sin(dlmb/2)**2
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+def _within_km_numpy(lat_p, lon_p, lat_c, lon_c, radius_km):
+    return haversine_km(lat_p[:, None], lon_p[:, None], lat_c[None, :], lon_c[None, :]) <= radius_km
+
+_within_km_kernel = None  # resolved on first large pairs_within_km call, so only callers pay for numba
+NUMBA_MIN_PAIRS = 5_000_000  # below this many point x centre pairs, numba's import/JIT cost outweighs the win
+
+def _within_km():
+    """The Numba kernel if numba is installed, else the NumPy broadcast (decided once, lazily)."""
+    global _within_km_kernel
+    if _within_km_kernel is not None:
+        return _within_km_kernel
+    try:
+        from numba import njit, prange
+    except ImportError:  # numba is optional
+        _within_km_kernel = _within_km_numpy
+        return _within_km_kernel
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _within_km_numba(lat_p, lon_p, lat_c, lon_c, radius_km):
+        out = np.empty((lat_p.shape[0], lat_c.shape[0]), dtype=np.bool_)
+        for i in prange(lat_p.shape[0]):
+            p1 = math.radians(lat_p[i])
+            for j in range(lat_c.shape[0]):
+                p2 = math.radians(lat_c[j])
+                dphi = p2 - p1
+                dlmb = math.radians(lon_c[j] - lon_p[i])
+                a = math.sin(dphi/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dlmb/2)**2
+                out[i, j] = 2 * 6371.0 * math.asin(math.sqrt(a)) <= radius_km
+        return out
+
+    _within_km_kernel = _within_km_numba
+    return _within_km_kernel
+
+def pairs_within_km(lat_p, lon_p, lat_c, lon_c, radius_km):
+    """
+    All (point, centre) index pairs whose haversine distance is <= radius_km.
+    Small inputs (< NUMBA_MIN_PAIRS pairs) use the NumPy broadcast; larger ones use a parallel
+    Numba kernel when numba is installed (only a bool matrix is materialised).
+    Points with NaN coordinates never match.
+    """
+    lat_p, lon_p = np.asarray(lat_p, dtype=float), np.asarray(lon_p, dtype=float)
+    lat_c, lon_c = np.asarray(lat_c, dtype=float), np.asarray(lon_c, dtype=float)
+    keep = np.flatnonzero(~(np.isnan(lat_p) | np.isnan(lon_p)))  # fastmath assumes no NaNs
+    within = _within_km() if keep.size * lat_c.size >= NUMBA_MIN_PAIRS else _within_km_numpy
+    pi, ci = np.nonzero(within(lat_p[keep], lon_p[keep], lat_c, lon_c, float(radius_km)))
+    return keep[pi], ci
+
+# ---------------------------
+# Async HTTP session + retry policy
+# ---------------------------
+import asyncio
+import aiohttp
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def make_session(limit: int = 16) -> aiohttp.ClientSession:
+    """
+    One pooled aiohttp session, reused across every request in a run.
+    Must be created (and closed) inside a running event loop:
+        async with make_session() as session: ...
+    """
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+
+class TransientAPIError(RuntimeError):
+    """The server answered 200 but reported a failure worth retrying (e.g. an Overpass query timeout)."""
+
+def is_transient(exc: BaseException) -> bool:
+    """True for errors worth retrying: timeouts, dropped connections, 429/5xx, TransientAPIError."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRY_STATUSES
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError, TransientAPIError))
+
+# The one retry policy for every HTTP call: exponential backoff with jitter (so concurrent
+# requests that failed together don't retry in lockstep), 5 attempts, transient errors only.
+http_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+
+def query_pairs(params: dict) -> list:
+    """Flatten {'k': [a, b]} into [('k', a), ('k', b)] (aiohttp wants repeated keys spelled out)."""
+    pairs = []
+    for k, v in params.items():
+        for item in (v if isinstance(v, (list, tuple)) else [v]):
+            pairs.append((k, str(item)))
+    return pairs
+
+# ---------------------------
+# On-disk JSON response cache
+# ---------------------------
+CACHE_DIR = Path(".cache") / "http"
+CACHE_TTL = 86400  # seconds
+
+def _cache_path(url: str, params: dict) -> Path:
+    key = json.dumps([url, sorted(query_pairs(params))])
+    return CACHE_DIR / (hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+def cache_get(url: str, params: dict, ttl: float = CACHE_TTL):
+    """Return the cached JSON for (url, params) if younger than ttl seconds, else None."""
+    p = _cache_path(url, params)
+    try:
+        if time.time() - p.stat().st_mtime > ttl:
+            return None
+        with open(p, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def cache_put(url: str, params: dict, payload) -> None:
+    """Store a JSON payload for (url, params); written to a temp file first so readers never see half a file."""
+    p = _cache_path(url, params)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f)
+    os.replace(tmp, p)
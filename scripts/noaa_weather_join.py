@@ -2,58 +2,58 @@
 """
 Join NOAA daily weather to geo events (by event date).
 Inputs  : geo_events_sample.csv  (repo root or ./data/)
-Outputs : data/events_with_noaa.csv
-Deps    : pandas, requests (no geo deps needed here)
+Outputs : data/events_with_noaa.parquet  (or .csv with --format csv)
+Deps    : pandas, numpy, pyarrow, aiohttp, tenacity (no geo deps needed here)
 Env     : NOAA_TOKEN must be set (https://www.ncdc.noaa.gov/cdo-web/token)
+Cache   : NCEI responses are cached under .cache/http/ for 24h (delete it to force a refetch)
 """
 from __future__ import annotations
-import os, time, math
+import os, math, asyncio
+from contextlib import nullcontext
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from pathlib import Path
-import requests
-from common import find_data_file, make_retry_session
+import aiohttp
+from common import find_data_file, arrow_schema, write_frames, haversine_km, make_session, http_retry, query_pairs, RETRY_STATUSES, cache_get, cache_put
 
 from dotenv import load_dotenv
 load_dotenv()  # load variables from .env if present
 
 NCEI_BASE = "https://www.ncei.noaa.gov/cdo-web/api/v2"
+NCEI_CONCURRENCY = 8  # NCEI allows ~5 req/s per token; keep a small number in flight
+WRITE_CHUNK_ROWS = 200_000  # events joined + written per slice
 
-def ncei_request(path: str, params: dict, token: str, timeout=(10,120), session=None):
-    session = session or make_retry_session()
+@http_retry
+async def ncei_request_async(session: aiohttp.ClientSession, path: str, params: dict, token: str,
+                             timeout=(10,120), sem: asyncio.Semaphore | None = None, use_cache: bool = True):
     url = f"{NCEI_BASE}/{path}"
+    # Responses are keyed on (url, params) only -- the token never reaches the cache
+    if use_cache and (cached := cache_get(url, params)) is not None:
+        return cached
     headers = {"token": token}
-    manual_retries = 2
-    for i in range(manual_retries + 1):
-        try:
-            r = session.get(url, headers=headers, params=params, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-            if i < manual_retries:
-                time.sleep(2 * (i + 1))
-                continue
-            raise
-        except requests.HTTPError:
-            raise RuntimeError(f"NCEI HTTP {r.status_code}: {r.text[:400]}")
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    async with sem or nullcontext():
+        async with session.get(url, headers=headers, params=query_pairs(params), timeout=client_timeout) as r:
+            if r.status in RETRY_STATUSES:
+                r.raise_for_status()  # transient -> retried with backoff
+            if r.status >= 400:
+                raise RuntimeError(f"NCEI HTTP {r.status}: {(await r.text())[:400]}")
+            js = await r.json(content_type=None)
+    if use_cache:
+        cache_put(url, params, js)
+    return js
 
 def bbox_from_point(lat: float, lon: float, km: float = 50.0):
     dlat = km / 111.0
     dlon = km / (111.0 * max(0.1, math.cos(math.radians(lat))))
     return (lon - dlon, lat - dlat, lon + dlon, lat + dlat)
 
-def haversine_km(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    from math import radians, sin, cos, asin, sqrt
-    p1, p2 = radians(lat1), radians(lat2)
-    dphi = radians(lat2 - lat1)
-    dlmb = radians(lon2 - lon1)
-    a = sin(dphi/2)**2 + cos(p1)*cos(p2)*sin(dlmb/2)**2
-    return 2 * R * asin(sqrt(a))
-
-def find_nearest_station(lat, lon, start, end, token, datasetid="GHCND", km=50, session=None):
-    session = session or make_retry_session()
+async def find_nearest_station(session, lat, lon, start, end, token, datasetid="GHCND", km=50, sem=None):
     minlon, minlat, maxlon, maxlat = bbox_from_point(lat, lon, km)
-    js = ncei_request(
+    js = await ncei_request_async(
+        session,
         "stations",
         {
             "datasetid": datasetid,
@@ -62,24 +62,28 @@ def find_nearest_station(lat, lon, start, end, token, datasetid="GHCND", km=50,
             "enddate": end,
             "limit": 1000,
         },
-        token, session=session
+        token, sem=sem
     )
     results = js.get("results", []) if isinstance(js, dict) else []
     if not results:
         return None
-    best = min(results, key=lambda s: haversine_km(lat, lon, s.get("latitude"), s.get("longitude")))
-    best = dict(best)
-    best["dist_km"] = haversine_km(lat, lon, best["latitude"], best["longitude"])
+    lats = np.array([s.get("latitude") for s in results], dtype=float)
+    lons = np.array([s.get("longitude") for s in results], dtype=float)
+    d = haversine_km(lat, lon, lats, lons)
+    if np.isnan(d).all():  # no station came back with usable coordinates
+        return None
+    idx = int(np.nanargmin(d))  # stations missing latitude/longitude (NaN) are never picked
+    best = dict(results[idx])
+    best["dist_km"] = float(d[idx])
     return best
 
-def fetch_daily_chunked(stationid, start, end, token, datatypes=("TMAX","TMIN","PRCP","WSF2"), chunk_days=30, limit=1000, session=None):
-    session = session or make_retry_session()
+async def fetch_daily_chunked(session, stationid, start, end, token, datatypes=("TMAX","TMIN","PRCP","WSF2"), chunk_days=30, limit=1000, sem=None):
     start_dt = pd.to_datetime(start).normalize()
     end_dt   = pd.to_datetime(end).normalize()
-    frames = []
-    current = start_dt
-    while current <= end_dt:
-        chunk_end = min(current + pd.Timedelta(days=chunk_days-1), end_dt)
+    windows = [(d, min(d + pd.Timedelta(days=chunk_days-1), end_dt))
+               for d in pd.date_range(start_dt, end_dt, freq=f"{chunk_days}D")]
+
+    async def fetch_window(current, chunk_end):
         params = {
             "datasetid": "GHCND",
             "stationid": stationid,
@@ -90,36 +94,52 @@ def fetch_daily_chunked(stationid, start, end, token, datatypes=("TMAX","TMIN","
             "datatypeid": list(datatypes),
         }
         try:
-            js = ncei_request("data", params, token, timeout=(10,120), session=session)
-            res = js.get("results", []) if isinstance(js, dict) else []
-            if res:
-                frames.append(pd.DataFrame(res))
+            js = await ncei_request_async(session, "data", params, token, timeout=(10,120), sem=sem)
+            return js.get("results", []) if isinstance(js, dict) else []
         except Exception as e:
             print(f"[WARN] NOAA chunk {current.date()}..{chunk_end.date()} failed: {e}")
-        current = chunk_end + pd.Timedelta(days=1)
+            return []
 
-    if not frames:
-        return pd.DataFrame(columns=["date"])
-    df = pd.concat(frames, ignore_index=True).drop_duplicates()
-    df["date"] = pd.to_datetime(df["date"], utc=True, errors="coerce").dt.tz_convert(None).dt.normalize()
-    df = df.pivot_table(index="date", columns="datatype", values="value", aggfunc="first").reset_index()
-    df.columns.name = None
-    return df
+    # All windows in flight at once; the semaphore keeps us under the NCEI rate limit
+    results = await asyncio.gather(*[fetch_window(c, e) for c, e in windows])
+    all_rows = []
+    for res in results:
+        all_rows.extend(res)
 
-def main():
+    if not all_rows:
+        return pd.DataFrame(columns=["date"])
+    # One DataFrame / one date parse for all windows; (date, datatype) is unique after the
+    # dedupe, so a pure reshape (unstack) replaces pivot_table's per-group aggregation.
+    # station/attributes are never materialised: single station, and unused downstream.
+    df = pd.DataFrame(all_rows, columns=["date","datatype","value"])
+    df["date"] = pd.to_datetime(df["date"], format="ISO8601", utc=True, errors="coerce").dt.tz_convert(None).dt.normalize()
+    df["datatype"] = df["datatype"].astype("category")
+    df = df.drop_duplicates(subset=["date","datatype"], keep="first")
+    out = df.set_index(["date","datatype"])["value"].unstack("datatype").reset_index()
+    out.columns.name = None
+    return out
+
+async def main_async(fmt="parquet"):
     token = os.environ.get("NOAA_TOKEN")
     if not token:
         raise SystemExit("Please set NOAA_TOKEN (https://www.ncdc.noaa.gov/cdo-web/token)")
 
     events_path = find_data_file("geo_events_sample.csv")
-    out_path = Path(find_data_file("events_with_noaa.csv"))
+    out_path = Path(find_data_file(f"events_with_noaa.{fmt}"))
     print(f"[i] Reading events: {events_path}")
-    events = pd.read_csv(events_path)
+    # pyarrow's reader is multi-threaded. All columns pass through to the output; the raw timestamp
+    # columns are pinned to text (pandas' engine="pyarrow" would re-type them before any dtype= cast)
+    # so they are written back exactly as given. Empty cells stay null, as with pd.read_csv.
+    events = pacsv.read_csv(events_path, convert_options=pacsv.ConvertOptions(
+        column_types={"date_created": pa.string(), "date_modified": pa.string()},
+        strings_can_be_null=True,
+    )).to_pandas()
 
     # Parse event times; sample uses naive microsecond strings
+    # format="ISO8601" skips pandas' per-value format inference
     events["_event_dt"] = pd.to_datetime(
         events["date_modified"].fillna(events["date_created"]),
-        utc=True, errors="coerce"
+        format="ISO8601", utc=True, errors="coerce"
     ).dt.tz_convert(None)
 
     # Window with 1-day padding, strict (no fallback)
@@ -140,22 +160,43 @@ def main():
 
     print(f"[i] Date window: {start}..{end}")
     print(f"[i] Finding nearest GHCND station near ({mid_lat:.4f},{mid_lng:.4f})")
-    station = find_nearest_station(mid_lat, mid_lng, start, end, token, km=50)
-    if station is None:
-        raise SystemExit("No nearby GHCND station found; increase km or adjust dates.")
-
-    print(f"[i] Station: {station.get('id')}  dist≈{station.get('dist_km'):.2f} km")
-    daily = fetch_daily_chunked(station["id"], start, end, token, datatypes=("TMAX","TMIN","PRCP","WSF2"), chunk_days=30)
+    sem = asyncio.Semaphore(NCEI_CONCURRENCY)
+    async with make_session() as session:
+        station = await find_nearest_station(session, mid_lat, mid_lng, start, end, token, km=50, sem=sem)
+        if station is None:
+            raise SystemExit("No nearby GHCND station found; increase km or adjust dates.")
+
+        print(f"[i] Station: {station.get('id')}  dist≈{station.get('dist_km'):.2f} km")
+        daily = await fetch_daily_chunked(session, station["id"], start, end, token,
+                                          datatypes=("TMAX","TMIN","PRCP","WSF2"), chunk_days=30, sem=sem)
     if daily.empty:
         raise SystemExit("No NOAA daily observations for this window.")
 
-    daily["noaa_date"] = pd.to_datetime(daily["date"], errors="coerce").dt.date
-    events["_event_date"] = events["_event_dt"].dt.date
+    # Day keys stay datetime64 (not object columns of dates) so they join and serialise as one type
+    daily["noaa_date"] = daily["date"]  # already parsed + normalized in fetch_daily_chunked
+    events["_event_date"] = events["_event_dt"].dt.normalize()
 
-    joined = events.merge(daily, left_on="_event_date", right_on="noaa_date", how="left")
+    # daily has at most one row per day: join against its index (one indexer for all columns,
+    # instead of a map per column) and let validate catch a non-unique day. Input columns that
+    # clash with NOAA ones (date, TMAX, ...) are kept as-is; the NOAA copies get a _noaa suffix.
+    # Join + write one slice of events at a time so the full joined table is never held in memory.
+    lookup = daily.set_index("noaa_date", drop=False)  # keep noaa_date as an output column too
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    joined.to_csv(out_path, index=False)
-    print(f"[✓] Wrote {out_path}  rows={len(joined)}")
+    join = dict(on="_event_date", how="left", rsuffix="_noaa", validate="m:1")
+    slices = (events.iloc[lo:lo + WRITE_CHUNK_ROWS].join(lookup, **join)
+              for lo in range(0, max(len(events), 1), WRITE_CHUNK_ROWS))
+    # One schema for every slice, typed from the full events/daily columns
+    schema = arrow_schema(events.iloc[:0].join(lookup, **join), events, lookup) if fmt == "parquet" else None
+    rows = write_frames(slices, out_path, schema=schema)
+    print(f"[✓] Wrote {out_path}  rows={rows}")
+
+def main(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--format", choices=("parquet","csv"), default="parquet",
+                    help="Output file format (default: parquet)")
+    args = ap.parse_args(argv)
+    asyncio.run(main_async(args.format))
 
 if __name__ == "__main__":
     main()
@@ -2,43 +2,62 @@
 """
 Tiny OSM amenity demo around each perimeter centroid.
 Inputs  : perimeter_sample.csv  (repo root or ./data/)
-Outputs : data/osm_amenities.csv
-Deps    : pandas, shapely, requests
+Outputs : data/osm_amenities.parquet  (or .csv with --format csv)
+Deps    : pandas, numpy, pyarrow, shapely, aiohttp, tenacity
 Note    : Overpass is a public API; be gentle (simple queries + small radius).
 """
 from __future__ import annotations
-import sys, json, time
+import sys, json, asyncio
+from contextlib import nullcontext
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import requests
-from shapely import wkt
+import aiohttp
+import shapely
 from shapely.geometry import shape
 from shapely.ops import unary_union
-from common import find_data_file, strip_srid, make_retry_session
+from common import find_data_file, write_frames, SRID_RE, pairs_within_km, make_session, http_retry, TransientAPIError
 
 from dotenv import load_dotenv
 load_dotenv()  # load variables from .env if present
 
 OVERPASS = "https://overpass-api.de/api/interpreter"
+OVERPASS_CONCURRENCY = 4  # public Overpass instance; don't hog its slots
+OSM_COLUMNS = ["osm_id","name","amenity","lat","lon","perim_id"]
+CELL_DECIMALS = 2         # centroids rounding to the same 0.01 deg cell share one query point
+OVERPASS_BATCH = 50       # centroids per union query; keeps queries small (server timeouts are detected + retried)
 
-def query_overpass(amenities, lat, lon, radius_m=3000, session=None):
+@http_retry
+async def query_overpass_async(session: aiohttp.ClientSession, amenities, points, radius_m=3000,
+                               timeout=(10,90), sem=None):
     """
-    Query nodes with the given amenities within a radius of (lat,lon).
-    Returns list of dicts with osm_id, name, amenity, lat, lon.
+    Query nodes with the given amenities within a radius of any of the (lat,lon) points,
+    as a single Overpass union. Returns list of dicts with osm_id, name, amenity, lat, lon.
     """
-    session = session or make_retry_session()
-    # Build OR filter for amenities
-    amenity_filters = "".join([f'node(around:{radius_m},{lat},{lon})["amenity"="{a}"];' for a in amenities])
+    # Build OR filter for every point x amenity: broadcast (points, 1) + (1, amenities) string arrays
+    lat_s, lon_s = (np.asarray(v, dtype=float).astype(str) for v in zip(*points))
+    around = np.char.add(np.char.add(f"node(around:{radius_m},", lat_s), np.char.add(",", lon_s))
+    amen_tags = np.char.add(np.char.add(')["amenity"="', np.asarray(amenities, dtype=str)), '"];')
+    amenity_filters = "".join(np.char.add(around[:, None], amen_tags[None, :]).ravel())
     q = f"""
-    [out:json][timeout:25];
+    [out:json][timeout:60];
     (
       {amenity_filters}
     );
     out center;
     """
-    r = session.get(OVERPASS, params={"data": q})
-    r.raise_for_status()
-    data = r.json()
+    # POST: a batched union easily outgrows URL length limits; gzip shrinks the JSON reply
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    async with sem or nullcontext():
+        async with session.post(OVERPASS, data={"data": q}, headers={"Accept-Encoding": "gzip"},
+                                timeout=client_timeout) as r:
+            r.raise_for_status()
+            data = await r.json(content_type=None)
+    # Overpass reports a query that ran past [timeout:] as HTTP 200 with a runtime-error remark
+    # and empty/partial elements -- never treat that as "no amenities"
+    remark = data.get("remark") or ""
+    if remark.startswith("runtime error"):
+        raise TransientAPIError(f"Overpass: {remark[:200]}")
     rows = []
     for el in data.get("elements", []):
         tags = el.get("tags", {})
@@ -51,51 +70,102 @@ def query_overpass(amenities, lat, lon, radius_m=3000, session=None):
         })
     return rows
 
+def assign_to_centroids(rows, centroids, radius_km, id_col="perim_id"):
+    """
+    Attach centroid ids (as column id_col) to each element returned by a batched query.
+    centroids are (id, lat, lon) tuples; an element belongs to every centroid within
+    radius_km of it (same semantics as one around: query per centroid).
+    Distances come from pairs_within_km (Numba kernel if available, else NumPy broadcast);
+    matching (element, centroid) pairs are gathered with one positional take, no per-row loop.
+    """
+    els = pd.DataFrame(rows, columns=OSM_COLUMNS[:-1])
+    if els.empty or not centroids:
+        return pd.DataFrame(columns=OSM_COLUMNS[:-1] + [id_col])
+    ids, c_lat, c_lon = (np.asarray(v) for v in zip(*centroids))
+    ei, ci = pairs_within_km(els["lat"].to_numpy(dtype=float), els["lon"].to_numpy(dtype=float),
+                             c_lat, c_lon, radius_km)
+    out = els.iloc[ei].reset_index(drop=True)
+    out[id_col] = ids[ci]
+    return out
+
+def group_into_cells(centroids, decimals=CELL_DECIMALS):
+    """
+    Collapse perimeter centroids that round to the same lat/lon grid cell (~1 km at 2 decimals).
+    Returns (cells, members): cells is [(cell_id, lat, lon)] using the first centroid seen in each
+    cell as its query point; members maps cell_id -> perim_id for every perimeter.
+    """
+    c = pd.DataFrame(centroids, columns=["perim_id","lat","lon"])
+    c["cell_id"] = c.groupby([c["lat"].round(decimals), c["lon"].round(decimals)], sort=False).ngroup()
+    reps = c.drop_duplicates("cell_id")
+    cells = list(zip(reps["cell_id"].tolist(), reps["lat"].tolist(), reps["lon"].tolist()))
+    return cells, c[["cell_id","perim_id"]]
+
+async def fetch_all_amenities(centroids, amenities, radius_m, radius_km, id_col="perim_id"):
+    """
+    One Overpass union per OVERPASS_BATCH (id, lat, lon) centroids (instead of one request each);
+    batches run concurrently, bounded by OVERPASS_CONCURRENCY. Matched ids land in column id_col.
+    """
+    empty = pd.DataFrame(columns=OSM_COLUMNS[:-1] + [id_col])
+    sem = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+    batches = [centroids[i:i+OVERPASS_BATCH] for i in range(0, len(centroids), OVERPASS_BATCH)]
+
+    async def one(session, batch):
+        ids = f"{batch[0][0]}..{batch[-1][0]}"
+        print(f"[i] OSM near cells {ids} ({len(batch)} points)  r={radius_km}km")
+        try:
+            rows = await query_overpass_async(session, amenities, [(lat, lon) for _, lat, lon in batch],
+                                              radius_m=radius_m, sem=sem)
+        except Exception as e:
+            print(f"[WARN] Overpass failed for cells {ids}: {e}")
+            return empty
+        return assign_to_centroids(rows, batch, radius_km, id_col=id_col)
+
+    async with make_session(limit=OVERPASS_CONCURRENCY) as session:
+        results = await asyncio.gather(*[one(session, b) for b in batches])
+    frames = [f for f in results if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else empty
+
 def main(argv=None):
     import argparse
     ap = argparse.ArgumentParser()
     ap.add_argument("--amenities", type=str, default="fire_station,hospital,police,school",
                     help="Comma-separated list of amenity keys to count (default: fire_station,hospital,police,school)")
     ap.add_argument("--radius-km", type=float, default=5.0, help="Search radius in kilometers (default: 5km)")
+    ap.add_argument("--format", choices=("parquet","csv"), default="parquet",
+                    help="Output file format (default: parquet)")
     args = ap.parse_args(argv)
 
     perim_path = find_data_file("perimeter_sample.csv")
-    out_path = Path(find_data_file("osm_amenities.csv"))
+    out_path = Path(find_data_file(f"osm_amenities.{args.format}"))
     print(f"[i] Reading perimeters: {perim_path}")
-    perims = pd.read_csv(perim_path, dtype=str)
+    if "geom" not in pd.read_csv(perim_path, nrows=0).columns:
+        raise SystemExit(f"No 'geom' column in {perim_path}; expected EWKT/WKT perimeter geometries.")
+    # Only geom is used (perim_id is the row position); Arrow-backed strings keep the regex strip fast
+    perims = pd.read_csv(perim_path, engine="pyarrow", usecols=["geom"], dtype_backend="pyarrow")
 
-    # Compute centroids from EWKT/WKT
-    centroids = []
-    for i, row in perims.iterrows():
-        wkt_text = strip_srid(row.get("geom",""))
-        if not wkt_text:
-            continue
-        try:
-            geom = wkt.loads(wkt_text)
-            c = geom.representative_point() if geom.is_empty else geom.centroid
-            centroids.append((i+1, c.y, c.x))  # (perim_id, lat, lon)
-        except Exception as e:
-            print(f"[WARN] Failed WKT parse on row {i}: {e}"); continue
+    # Compute centroids from EWKT/WKT in one vectorized shapely pass
+    wkts = perims["geom"].str.replace(SRID_RE.pattern, "", regex=True)
+    has_text = wkts.notna() & (wkts != "")
+    geoms = shapely.from_wkt(wkts.where(has_text).to_numpy(dtype=object, na_value=None), on_invalid="ignore")
+    ok = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    for i in np.flatnonzero(has_text.to_numpy() & ~ok):
+        print(f"[WARN] Failed WKT parse on row {i}: invalid or empty geometry")
+    cents = shapely.centroid(geoms[ok])
+    perim_ids = np.flatnonzero(ok) + 1
+    centroids = list(zip(perim_ids.tolist(), shapely.get_y(cents).tolist(), shapely.get_x(cents).tolist()))  # (perim_id, lat, lon)
 
     amenities = [a.strip() for a in args.amenities.split(",") if a.strip()]
     radius_m = int(args.radius_km * 1000)
 
-    session = make_retry_session()
-    all_rows = []
-    for perim_id, lat, lon in centroids:
-        print(f"[i] OSM near perimeter {perim_id} at ({lat:.5f},{lon:.5f})  r={args.radius_km}km")
-        try:
-            rows = query_overpass(amenities, lat, lon, radius_m=radius_m, session=session)
-            for r in rows:
-                r["perim_id"] = perim_id
-            all_rows.extend(rows)
-            time.sleep(1.2)  # be nice to Overpass
-        except Exception as e:
-            print(f"[WARN] Overpass failed for perimeter {perim_id}: {e}")
-
-    df = pd.DataFrame(all_rows, columns=["osm_id","name","amenity","lat","lon","perim_id"])
+    # Perimeters whose centroids fall in the same ~1 km cell are queried once and share the result
+    cells, members = group_into_cells(centroids)
+    print(f"[i] {len(centroids)} perimeter centroids -> {len(cells)} unique cells")
+    by_cell = asyncio.run(fetch_all_amenities(cells, amenities, radius_m, args.radius_km, id_col="cell_id"))
+    df = (by_cell.merge(members, on="cell_id")
+          .sort_values("perim_id", kind="stable")[OSM_COLUMNS]
+          .reset_index(drop=True))
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(out_path, index=False)
+    write_frames([df], out_path)
     print(f"[✓] Wrote {out_path}  rows={len(df)}")
 
     # quick pivot summary